@@ -1,25 +1,41 @@
 # main.py — SmartStudy AI (Cloud Run + GCS + Firestore + Gemini)
 import os
-import json
+import asyncio
+import orjson
 import re
 import tempfile
-import traceback
 import logging
+import hashlib
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+from email.utils import formatdate
 
 from dotenv import load_dotenv
 load_dotenv()  # safe: ignored in Cloud Run if .env not present
 
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
+from fastapi import FastAPI, File, UploadFile, Form, Request
+from fastapi.responses import ORJSONResponse, HTMLResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
 
 # GCP
 from google.cloud import storage, firestore
+from google.cloud.storage import transfer_manager
 from google.cloud.firestore import SERVER_TIMESTAMP
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
+from tenacity import retry, retry_if_exception_type, wait_exponential_jitter, stop_after_attempt
 
 # Gemini
 import google.generativeai as genai
+from google import genai as genai_batch  # google-genai SDK, used for Batch Mode
+
+from cachetools import TTLCache
+
+# optional, more forgiving JSON parser used as a fallback
+try:
+    import json5 as _json5
+except ImportError:
+    _json5 = None
 
 # PDF
 from reportlab.lib.pagesizes import letter
@@ -34,6 +50,27 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")  # optional if using ADC
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 PROJECT_ID = os.getenv("GCP_PROJECT") or os.getenv("GOOGLE_CLOUD_PROJECT")
 PORT = int(os.getenv("PORT", 8080))
+BATCH_MODEL = "gemini-2.5-flash"
+BATCH_POLL_CONCURRENCY = 8  # batch jobs collected in parallel per /poll-batches call
+BATCH_CLAIM_LEASE = timedelta(minutes=15)  # a PROCESSING claim older than this is treated as abandoned
+BULK_WRITE_MAX_ATTEMPTS = 5
+BATCH_DONE_STATES = ("JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED")
+GEMINI_FILE_ACTIVE_TIMEOUT = 300  # seconds to wait for Files API processing (video/audio)
+GEMINI_FILE_POLL_INTERVAL = 2
+SUMMARY_TEXT_MAX_TOKENS = 1500   # output budget for {"summary": ...} from pasted text
+SUMMARY_FILE_MAX_TOKENS = 2000   # output budget for {"summary": ...} from an uploaded file
+FLASHCARD_MAX_TOKENS = 1200      # output budget for five flashcards
+BATCH_FLASHCARD_MAX_TOKENS = 900 # Batch Mode answer budget for five flashcards
+BATCH_THINKING_BUDGET = 0        # Batch Mode lines skip thinking so the whole budget goes to the answer
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+GEMINI_SLOT_TIMEOUT = 30  # seconds a request waits for a free Gemini slot before answering gemini_busy
+GEMINI_CACHE_SIZE = 1024
+GEMINI_CACHE_TTL = 3600  # seconds
+NOTE_CACHE_SIZE = 1024
+NOTE_CACHE_TTL = 300  # seconds
+GCS_PARALLEL_THRESHOLD = 16 * 1024 * 1024  # files above this use parallel chunked upload
+GCS_CHUNK_SIZE = 32 * 1024 * 1024
+GCS_UPLOAD_WORKERS = 8
 
 # Configure Gemini (api key or None -> use ADC)
 if GEMINI_API_KEY:
@@ -47,7 +84,14 @@ else:
     except Exception:
         logger.info("Gemini left unconfigured; ensure GEMINI_API_KEY or ADC is available.")
 
-app = FastAPI(title="SmartStudy AI")
+# Batch Mode lives in the newer google-genai client
+batch_client = None
+try:
+    batch_client = genai_batch.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else genai_batch.Client()
+except Exception as e:
+    logger.warning("Gemini batch client unavailable; batch endpoints disabled. Error: %s", e)
+
+app = FastAPI(title="SmartStudy AI", default_response_class=ORJSONResponse)
 
 # -------- GCP clients (defensive) --------
 storage_client = None
@@ -62,10 +106,174 @@ except Exception as e:
     storage_client = None
     firestore_client = None
 
+# one Bucket handle for all uploads
+BUCKET = storage_client.bucket(BUCKET_NAME) if storage_client and BUCKET_NAME else None
+
+# -------- prompt templates --------
+# Fixed instruction prefixes, sent as the model's system instruction so only the
+# variable text/file changes between requests (Gemini 2.5 caches the shared prefix implicitly).
+PROMPT_TEMPLATES = {
+    "summary_text": (
+        "Generate structured study material in STRICT JSON:\n"
+        "{\n"
+        "  \"summary\": \"...\"\n"
+        "}\n\n"
+        "Text to summarize:\n"
+    ),
+    "summary_file": """
+        You are an AI study assistant. Extract readable text from the uploaded file.
+        Then generate structured study material in strictly valid JSON:
+        {
+            "summary": "..."
+        }
+        Return ONLY JSON. No explanation text.
+        """,
+    "flashcards": (
+        "Your task is to return ONE single JSON object with EXACTLY the following keys:\n\n"
+        "{\n"
+        "  \"flashcards\": [\n"
+        "    {\"q\": \"\", \"a\": \"\"},\n"
+        "    {\"q\": \"\", \"a\": \"\"},\n"
+        "    {\"q\": \"\", \"a\": \"\"},\n"
+        "    {\"q\": \"\", \"a\": \"\"},\n"
+        "    {\"q\": \"\", \"a\": \"\"}\n"
+        "  ],\n"
+        "}\n\n"
+        "Rules:\n"
+        "- Return ONLY JSON.\n"
+        "- No markdown.\n"
+        "- No extra text.\n"
+        "- No explanations.\n"
+        "- All questions must be based STRICTLY on the provided text.\n\n"
+        "Text:\n"
+    ),
+}
+
+# Gemini is told to return exactly these shapes (response_mime_type=application/json)
+SUMMARY_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"summary": {"type": "STRING"}},
+    "required": ["summary"],
+}
+FLASHCARD_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "flashcards": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {"q": {"type": "STRING"}, "a": {"type": "STRING"}},
+                "required": ["q", "a"],
+            },
+        },
+    },
+    "required": ["flashcards"],
+}
+RESPONSE_SCHEMAS = {
+    "summary_text": SUMMARY_SCHEMA,
+    "summary_file": SUMMARY_SCHEMA,
+    "flashcards": FLASHCARD_SCHEMA,
+}
+
+def generation_config_for(template: str, max_output_tokens: int, temperature: float) -> dict:
+    config = {"max_output_tokens": max_output_tokens, "temperature": temperature}
+    if template in RESPONSE_SCHEMAS:
+        config["response_mime_type"] = "application/json"
+        config["response_schema"] = RESPONSE_SCHEMAS[template]
+    return config
+
+# Model objects are safe to share across requests; build each (template, model) pair once
+_template_models = {}
+
+def get_template_model(template: str, model_name: str = "models/gemini-2.5-flash"):
+    """
+    Return the shared GenerativeModel carrying the template as its system instruction.
+    """
+    key = (template, model_name)
+    model = _template_models.get(key)
+    if model is None:
+        model = _template_models[key] = genai.GenerativeModel(model_name, system_instruction=PROMPT_TEMPLATES[template])
+    return model
+
+# -------- Gemini rate limiting --------
+# caps in-flight Gemini calls per instance so bursts queue here instead of hitting RPM/TPM limits
+_GEMINI_SEM = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+GEMINI_BUSY = {"error": "gemini_busy", "detail": "Gemini is overloaded right now, please retry shortly."}
+
+class GeminiBusyError(Exception):
+    """No Gemini slot freed up within GEMINI_SLOT_TIMEOUT."""
+
+async def acquire_gemini_slot():
+    """
+    Take a _GEMINI_SEM slot, waiting at most GEMINI_SLOT_TIMEOUT. The caller releases it.
+    """
+    try:
+        await asyncio.wait_for(_GEMINI_SEM.acquire(), GEMINI_SLOT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise GeminiBusyError(f"no Gemini slot free after {GEMINI_SLOT_TIMEOUT}s") from None
+
+# -------- response cache --------
+# parsed Gemini results keyed by a hash of everything that shapes the output
+_gemini_cache = TTLCache(maxsize=GEMINI_CACHE_SIZE, ttl=GEMINI_CACHE_TTL)
+
+def gemini_cache_key(prompt: str, model_name: str, template: str, max_output_tokens: int, temperature: float) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in (model_name, template or "", str(max_output_tokens), str(temperature), prompt):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def _cacheable(result) -> bool:
+    # only keep clean parses; errors and raw_output fallbacks are worth retrying
+    return isinstance(result, dict) and "error" not in result and "raw_output" not in result
+
 # -------- helpers --------
+def error_payload(e: Exception, message: str) -> dict:
+    """
+    Log the full stack server-side under a trace id and return a client-safe error body.
+    Call from inside an except block.
+    """
+    trace_id = uuid4().hex
+    logger.exception("%s [trace_id=%s]", message, trace_id)
+    return {"error": type(e).__name__, "detail": str(e), "trace_id": trace_id}
+
+_FENCE_RE = re.compile(r"```(?:json)?|`")
+
+def _find_json_object(text: str) -> str:
+    """
+    Return the first balanced {...} block in text with a single linear scan
+    (quote/escape aware). Falls back to first "{" .. last "}" if it never closes.
+    """
+    start = text.find("{")
+    if start == -1:
+        return text
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    end = text.rfind("}")
+    return text[start:end + 1] if end > start else text
+
 def extract_json(text: str):
     """
     Attempt to extract a JSON object from text and parse it.
+    0) Parse as-is (responses requested with response_mime_type=application/json)
     1) Strip code fences
     2) Find first {...} block
     3) Try json.loads, then json5, else return raw_output
@@ -73,22 +281,26 @@ def extract_json(text: str):
     if not text:
         return {"raw_output": ""}
 
-    cleaned = text.replace("```json", "").replace("```", "").replace("`", "").strip()
-    # find JSON object
-    match = re.search(r"\{[\s\S]*\}", cleaned)
-    if match:
-        cleaned = match.group(0)
-    # try strict json
+    # happy path: schema-constrained responses are already plain JSON
     try:
-        return json.loads(cleaned)
+        return orjson.loads(text)
     except Exception:
         pass
-    # fallback to json5 (more forgiving)
+
+    cleaned = _FENCE_RE.sub("", text).strip()
+    # find JSON object
+    cleaned = _find_json_object(cleaned)
+    # try strict json
     try:
-        import json5
-        return json5.loads(cleaned)
+        return orjson.loads(cleaned)
     except Exception:
         pass
+    # fallback to json5 (more forgiving)
+    if _json5 is not None:
+        try:
+            return _json5.loads(cleaned)
+        except Exception:
+            pass
     # last resort return raw trimmed text
     return {"raw_output": cleaned}
 
@@ -110,188 +322,488 @@ def parse_gemini_response(response):
         if not parts:
             # maybe text accessor isn't available
             return {"error": "No text returned", "finish_reason": getattr(candidate, "finish_reason", None)}
-        full_text = ""
+        texts = []
         for p in parts:
             # some parts are objects with .text
             if hasattr(p, "text"):
-                full_text += p.text
+                texts.append(p.text)
             elif isinstance(p, dict) and "text" in p:
-                full_text += p["text"]
+                texts.append(p["text"])
             elif isinstance(p, str):
-                full_text += p
+                texts.append(p)
         # attempt JSON extraction
-        return extract_json(full_text)
+        return extract_json("".join(texts))
     except Exception as e:
-        logger.exception("Failed to parse Gemini response: %s", e)
-        return {"error": "parse_failed", "traceback": traceback.format_exc()}
+        return error_payload(e, "Failed to parse Gemini response")
 def convert_to_english(ai_out):
-    final = []
-
+    if not isinstance(ai_out, dict):
+        return ""
     # Flashcards → Q/A format
-    if "flashcards" in ai_out:
-        for i, fc in enumerate(ai_out["flashcards"], 1):
-            final.append(f"Q{i}: {fc['q']}\nA: {fc['a']}\n")
-
+    flashcards = [
+        f"Q{i}: {fc.get('q', '')}\nA: {fc.get('a', '')}\n"
+        for i, fc in enumerate(ai_out.get("flashcards") or [], 1)
+    ]
     # MCQs → Q/A format
-    if "mcqs" in ai_out:
-        for i, m in enumerate(ai_out["mcqs"], 1):
-            final.append(f"Q{i}: {m['q']}\nAnswer: {m['answer']}\n")
+    mcqs = [
+        f"Q{i}: {m.get('q', '')}\nAnswer: {m.get('answer', '')}\n"
+        for i, m in enumerate(ai_out.get("mcqs") or [], 1)
+    ]
+    return "\n".join(flashcards + mcqs)
+
+
+# Each attempt takes its own _GEMINI_SEM slot, so the backoff sleeps between attempts don't hold one
+gemini_retry = retry(
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable)),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+@gemini_retry
+async def generate_with_retry(model, contents, generation_config: dict):
+    """
+    Run generate_content_async under a _GEMINI_SEM slot, retried with exponential backoff on 429/503.
+    """
+    await acquire_gemini_slot()
+    try:
+        return await model.generate_content_async(contents, generation_config=generation_config)
+    finally:
+        _GEMINI_SEM.release()
 
-    return "\n".join(final)
+@gemini_retry
+async def start_gemini_stream(model, contents, generation_config: dict):
+    """
+    Start a streamed generate_content_async, retried like generate_with_retry.
+    Returns the response with a _GEMINI_SEM slot held; the caller releases it once the stream is read.
+    """
+    await acquire_gemini_slot()
+    try:
+        return await model.generate_content_async(contents, generation_config=generation_config, stream=True)
+    except BaseException:
+        _GEMINI_SEM.release()
+        raise
 
+_STREAM_END = object()
 
-def call_gemini(prompt: str, model_name: str = "models/gemini-2.5-flash", max_output_tokens: int = 1500):
+async def _read_gemini_stream(model, contents, generation_config: dict, queue: asyncio.Queue):
     """
-    Call Gemini generate_content with a text prompt and return parsed JSON or raw_output.
+    Push streamed text chunks onto queue, then _STREAM_END. An exception is queued instead of raised.
     """
     try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(
-            prompt,
-            generation_config={
-                "max_output_tokens": max_output_tokens,
-                "temperature": 0.3,
-            }
-        )
-        return parse_gemini_response(response)
+        response = await start_gemini_stream(model, contents, generation_config)
+        try:
+            async for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # chunk without text parts (e.g. finish/safety metadata)
+                    continue
+                queue.put_nowait(text)
+        finally:
+            _GEMINI_SEM.release()
+    except Exception as e:
+        queue.put_nowait(e)
+    finally:
+        queue.put_nowait(_STREAM_END)
+
+async def stream_and_save(model, contents, generation_config: dict, user_id: str, title: str,
+                          cache_key: str = None):
+    """
+    Stream Gemini output as NDJSON lines: {"text": ...} per chunk, then a final
+    {"status": "ok", "doc_id": ..., "result": ...} once the parsed result is saved.
+    With cache_key set, a cached result skips Gemini and goes straight to the final line.
+    """
+    try:
+        if cache_key and cache_key in _gemini_cache:
+            result = _gemini_cache[cache_key]
+            doc_id = await save_to_firestore(user_id, title, result)
+            yield orjson.dumps({"status": "ok", "doc_id": doc_id, "result": result, "cached": True}) + b"\n"
+            return
+
+        # ---------- STREAM RAW TEXT ----------
+        # Gemini is read into a queue by a separate task, so the semaphore slot is held only
+        # for the upstream read and not while a slow client drains its socket.
+        queue = asyncio.Queue()
+        reader = asyncio.create_task(_read_gemini_stream(model, contents, generation_config, queue))
+        chunks = []
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                chunks.append(item)
+                yield orjson.dumps({"text": item}) + b"\n"
+        finally:
+            # client went away mid-stream: stop reading from Gemini
+            reader.cancel()
+
+        if not chunks:
+            yield orjson.dumps({"error": "No text returned from Gemini"}) + b"\n"
+            return
+
+        # ---------- EXTRACT JSON ----------
+        raw = await asyncio.to_thread(extract_json, "".join(chunks))
+
+        # If backend output is { "raw_output": "{...json...}" }
+        if isinstance(raw, dict) and "raw_output" in raw:
+            try:
+                result = orjson.loads(raw["raw_output"])
+            except:
+                result = raw
+        else:
+            result = raw
+        if cache_key and _cacheable(result):
+            _gemini_cache[cache_key] = result
+
+        # ---------- SAVE ----------
+        doc_id = await save_to_firestore(user_id, title, result)
+        yield orjson.dumps({"status": "ok", "doc_id": doc_id, "result": result}) + b"\n"
+
+    except (ResourceExhausted, ServiceUnavailable, GeminiBusyError) as e:
+        logger.warning("Gemini stream gave up: %s", e)
+        yield orjson.dumps(GEMINI_BUSY) + b"\n"
     except Exception as e:
-        logger.exception("Gemini call failed: %s", e)
-        return {"error": "gemini_call_failed", "traceback": traceback.format_exc()}
+        yield orjson.dumps(error_payload(e, "Gemini stream failed")) + b"\n"
 
-def call_gemini_with_file(file_bytes: bytes, mime_type: str, prompt: str, model_name: str = "models/gemini-2.5-flash", max_output_tokens: int = 2000):
+async def call_gemini(text: str, template: str, model_name: str = "models/gemini-2.5-flash", max_output_tokens: int = SUMMARY_TEXT_MAX_TOKENS,
+                      use_cache: bool = True):
     """
-    Send a binary file + prompt to Gemini. Gemini SDK expects a list: [file_part, prompt]
-    file_part: {"mime_type": "...", "data": b'...'}
+    Call Gemini generate_content_async and return parsed JSON or raw_output.
+    The PROMPT_TEMPLATES entry goes out as the system instruction; text carries only the variable input.
+    Repeat prompts are answered from an in-process TTL cache; use_cache=False forces a fresh call.
     """
+    cache_key = gemini_cache_key(text, model_name, template, max_output_tokens, 0.3)
+    if use_cache and cache_key in _gemini_cache:
+        return _gemini_cache[cache_key]
     try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(
-            [
-                {"mime_type": mime_type, "data": file_bytes},
-                prompt
-            ],
-            generation_config={"max_output_tokens": max_output_tokens, "temperature": 0.3}
+        model = get_template_model(template, model_name)
+        response = await generate_with_retry(
+            model,
+            text,
+            generation_config=generation_config_for(template, max_output_tokens, 0.3)
         )
-        return parse_gemini_response(response)
+        result = await asyncio.to_thread(parse_gemini_response, response)
+        if _cacheable(result):
+            _gemini_cache[cache_key] = result
+        return result
+    except (ResourceExhausted, ServiceUnavailable, GeminiBusyError) as e:
+        logger.warning("Gemini call gave up: %s", e)
+        return dict(GEMINI_BUSY)
     except Exception as e:
-        logger.exception("Gemini file call failed: %s", e)
-        return {"error": "gemini_file_call_failed", "traceback": traceback.format_exc()}
+        return error_payload(e, "Gemini call failed")
 
-def save_to_firestore(user_id: str, title: str, data: dict):
-    if firestore_client is None:
-        raise RuntimeError("Firestore client not initialized. Ensure ADC or service account is configured.")
-    doc_ref = firestore_client.collection("users").document(user_id).collection("notes").document()
+# saved notes are never modified, so their text can be cached briefly per (user_id, doc_id)
+_note_text_cache = TTLCache(maxsize=NOTE_CACHE_SIZE, ttl=NOTE_CACHE_TTL)
+
+async def load_note_text(user_id: str, doc_id: str):
+    """
+    Return the summary text of a saved note, or None if the note does not exist.
+    Only the summary/raw_output fields are fetched, off the event loop.
+    """
+    key = (user_id, doc_id)
+    if key in _note_text_cache:
+        return _note_text_cache[key]
+    doc_ref = firestore_client.collection("users").document(user_id)\
+                              .collection("notes").document(doc_id)
+    doc = await asyncio.to_thread(doc_ref.get, field_paths=["result.summary", "result.raw_output"])
+    if not doc.exists:
+        return None
+    stored = (doc.to_dict() or {}).get("result", {})
+    text = stored.get("summary") or stored.get("raw_output")
+    if not text:
+        # neither field set (e.g. a flashcard note): fall back to the whole result
+        doc = await asyncio.to_thread(doc_ref.get, field_paths=["result"])
+        stored = (doc.to_dict() or {}).get("result", {})
+        text = orjson.dumps(stored, default=str).decode()
+    _note_text_cache[key] = text
+    return text
+
+def build_flashcard_prompt(text: str) -> str:
+    """Full flashcard prompt for paths that send no system instruction (Batch Mode)."""
+    return PROMPT_TEMPLATES["flashcards"] + text
+
+def build_flashcard_batch_request(text: str) -> dict:
+    """GenerateContentRequest body for one Batch Mode line."""
+    config = generation_config_for("flashcards", BATCH_FLASHCARD_MAX_TOKENS, 0.3)
+    # thinking tokens count against max_output_tokens on 2.5 models; the google-genai request
+    # format can bound them, so the 900-token cap is left entirely to the answer
+    config["thinking_config"] = {"thinking_budget": BATCH_THINKING_BUDGET}
+    return {
+        "contents": [{"parts": [{"text": build_flashcard_prompt(text)}]}],
+        "generation_config": config,
+    }
+
+def _new_note(user_id: str, title: str, data: dict, doc_id: str = None):
+    # doc_id=None lets Firestore pick an id
+    doc_ref = firestore_client.collection("users").document(user_id).collection("notes").document(doc_id)
     payload = {
         "title": title,
         "result": data,
         "created_at": SERVER_TIMESTAMP
     }
-    doc_ref.set(payload)
+    return doc_ref, payload
+
+async def save_to_firestore(user_id: str, title: str, data: dict, doc_id: str = None):
+    if firestore_client is None:
+        raise RuntimeError("Firestore client not initialized. Ensure ADC or service account is configured.")
+    doc_ref, payload = _new_note(user_id, title, data, doc_id)
+    # blocking gRPC call; keep it off the event loop
+    await asyncio.to_thread(doc_ref.set, payload)
     return doc_ref.id
 
+def save_many_to_firestore(user_id: str, title: str, notes: dict):
+    """
+    Save many notes for one user with a BulkWriter (parallel, batched writes).
+    notes maps the note doc id to its data. Writes are set() on fixed ids, so re-running is safe.
+    Returns the written ids; raises RuntimeError if any write still fails after retries.
+    """
+    if firestore_client is None:
+        raise RuntimeError("Firestore client not initialized. Ensure ADC or service account is configured.")
+    written = []
+    failed = {}
+
+    def on_result(doc_ref, write_result, bulk_writer):
+        written.append(doc_ref.id)
+
+    def on_error(failure, bulk_writer) -> bool:
+        # returning True retries; once we stop, record it instead of dropping it silently
+        if failure.attempts < BULK_WRITE_MAX_ATTEMPTS:
+            return True
+        failed[failure.operation.reference.id] = failure.message
+        return False
+
+    bw = firestore_client.bulk_writer()
+    bw.on_write_result(on_result)
+    bw.on_write_error(on_error)
+    try:
+        for doc_id, data in notes.items():
+            doc_ref, payload = _new_note(user_id, title, data, doc_id)
+            bw.set(doc_ref, payload)
+        bw.flush()
+    finally:
+        bw.close()
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(notes)} note writes failed: {failed}")
+    return written
+
+def submit_flashcard_batch(requests: list, display_name: str) -> str:
+    """
+    Write batch requests as JSONL, upload them via the Files API and start a Gemini batch job.
+    Each request looks like {"key": ..., "request": {"contents": [...]}}. Returns the job name.
+    """
+    if batch_client is None:
+        raise RuntimeError("Gemini batch client not initialized. Ensure GEMINI_API_KEY or ADC is configured.")
+    with tempfile.NamedTemporaryFile("wb", suffix=".jsonl", delete=False) as f:
+        for r in requests:
+            f.write(orjson.dumps(r) + b"\n")
+        jsonl_path = f.name
+    try:
+        uploaded = batch_client.files.upload(
+            file=jsonl_path,
+            config={"display_name": display_name, "mime_type": "jsonl"}
+        )
+        batch_job = batch_client.batches.create(
+            model=BATCH_MODEL,
+            src=uploaded.name,
+            config={"display_name": display_name}
+        )
+    finally:
+        os.remove(jsonl_path)
+    return batch_job.name
+
+def parse_batch_line(item: dict):
+    """
+    Parse one line of a batch result file ({"key": ..., "response": {...}} or {"key": ..., "error": {...}}).
+    """
+    if "response" not in item:
+        return {"error": "batch_request_failed", "detail": item.get("error")}
+    candidates = item["response"].get("candidates") or []
+    if not candidates:
+        return {"error": "no candidates in Gemini response"}
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return extract_json("".join(p.get("text", "") for p in parts))
+
+@firestore.transactional
+def _claim_batch_job(transaction, job_ref) -> bool:
+    snap = job_ref.get(transaction=transaction)
+    if not snap.exists:
+        return False
+    job = snap.to_dict()
+    if job.get("state") == "PROCESSING":
+        claimed_at = job.get("claimed_at")
+        if claimed_at and datetime.now(timezone.utc) - claimed_at < BATCH_CLAIM_LEASE:
+            return False
+    elif job.get("state") != "PENDING":
+        return False
+    transaction.update(job_ref, {"state": "PROCESSING", "claimed_at": SERVER_TIMESTAMP})
+    return True
+
+def claim_batch_job(job_ref) -> bool:
+    """
+    Atomically move a batch job from PENDING (or an abandoned PROCESSING claim) to PROCESSING.
+    Returns False if another poll already holds it or it is finished.
+    """
+    return _claim_batch_job(firestore_client.transaction(), job_ref)
+
+async def process_batch_job(snap):
+    """
+    Collect one finished Gemini batch job. Returns the final state, or None if the job
+    is still running or another poll claimed it.
+    """
+    job_doc = snap.to_dict()
+    batch_job = await asyncio.to_thread(batch_client.batches.get, name=job_doc["job_name"])
+    state = batch_job.state.name
+    if state not in BATCH_DONE_STATES:
+        return None
+    if not await asyncio.to_thread(claim_batch_job, snap.reference):
+        return None
+
+    try:
+        if state == "JOB_STATE_SUCCEEDED":
+            content = await asyncio.to_thread(batch_client.files.download, file=batch_job.dest.file_name)
+            notes = {}
+            result_doc_ids = {}
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                item = orjson.loads(line)
+                key = str(item.get("key"))
+                # deterministic id: a retried poll overwrites instead of duplicating
+                result_doc_ids[key] = f"{snap.id}-{key}"
+                notes[result_doc_ids[key]] = parse_batch_line(item)
+            await asyncio.to_thread(save_many_to_firestore, job_doc["user_id"], job_doc["title"], notes)
+            update = {"state": "SUCCEEDED", "result_doc_ids": result_doc_ids}
+        else:
+            update = {"state": state.replace("JOB_STATE_", "")}
+        update["finished_at"] = SERVER_TIMESTAMP
+        await asyncio.to_thread(snap.reference.update, update)
+        return update["state"]
+    except Exception:
+        # release the claim so the next poll retries this job
+        try:
+            await asyncio.to_thread(snap.reference.update, {"state": "PENDING"})
+        except Exception as release_error:
+            logger.warning("Could not release batch job %s: %s", snap.id, release_error)
+        raise
+
+async def wait_for_active_file(gemini_file):
+    """
+    Poll the Files API until an uploaded file leaves PROCESSING (video/audio take a while).
+    Returns the ACTIVE file; raises if processing fails or times out.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GEMINI_FILE_ACTIVE_TIMEOUT
+    while gemini_file.state.name == "PROCESSING":
+        if loop.time() > deadline:
+            raise TimeoutError(f"Gemini is still processing {gemini_file.name}")
+        await asyncio.sleep(GEMINI_FILE_POLL_INTERVAL)
+        gemini_file = await asyncio.to_thread(genai.get_file, gemini_file.name)
+    if gemini_file.state.name != "ACTIVE":
+        raise RuntimeError(f"Gemini could not process {gemini_file.name}: {gemini_file.state.name}")
+    return gemini_file
+
 def upload_to_gcs(local_path: str, dest_blob_name: str):
-    if storage_client is None:
-        raise RuntimeError("Storage client not initialized. Ensure ADC or service account is configured.")
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(dest_blob_name)
-    blob.upload_from_filename(local_path)
+    if BUCKET is None:
+        raise RuntimeError("Storage bucket not initialized. Ensure ADC or service account and BUCKET_NAME are configured.")
+    blob = BUCKET.blob(dest_blob_name)
+    if os.path.getsize(local_path) > GCS_PARALLEL_THRESHOLD:
+        # large PDFs/audio: upload chunks over parallel streams (XML multipart upload).
+        # Threads, not the default process pool: forking a worker that holds gRPC channels is unsafe.
+        transfer_manager.upload_chunks_concurrently(
+            local_path, blob, chunk_size=GCS_CHUNK_SIZE, max_workers=GCS_UPLOAD_WORKERS,
+            worker_type=transfer_manager.THREAD
+        )
+    else:
+        blob.upload_from_filename(local_path)
     # Return standard storage URL (works if bucket is public or you handle IAM)
     return f"https://storage.googleapis.com/{BUCKET_NAME}/{dest_blob_name}"
 
 
 
+# -------- frontend (read once at import) --------
+_FRONTEND_HTML = None
+_FRONTEND_ETAG = None
+_FRONTEND_LAST_MODIFIED = None
+try:
+    with open("frontend.html", "rb") as f:
+        _FRONTEND_HTML = f.read()
+    _FRONTEND_ETAG = '"' + hashlib.sha256(_FRONTEND_HTML).hexdigest()[:32] + '"'
+    _FRONTEND_LAST_MODIFIED = formatdate(os.path.getmtime("frontend.html"), usegmt=True)
+except FileNotFoundError:
+    logger.warning("frontend.html not found; / will serve a placeholder page.")
+
+
 # -------- routes --------
 @app.get("/", response_class=HTMLResponse)
-def home():
+def home(request: Request):
     """Serve frontend.html (make sure it's present)"""
-    try:
-        with open("frontend.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read(), status_code=200)
-    except FileNotFoundError:
+    if _FRONTEND_HTML is None:
         return HTMLResponse("<h3>SmartStudy AI</h3><p>Frontend not found. Upload frontend.html to project root.</p>", status_code=200)
+    headers = {"Cache-Control": "public, max-age=300", "ETag": _FRONTEND_ETAG, "Last-Modified": _FRONTEND_LAST_MODIFIED}
+    if request.headers.get("if-none-match") == _FRONTEND_ETAG:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=_FRONTEND_HTML, status_code=200, headers=headers)
 
 @app.post("/process-text")
-async def process_text(user_id: str = Form(...), title: str = Form(...), text: str = Form(...)):
-    prompt = (
-        "Generate structured study material in STRICT JSON:\n"
-        "{\n"
-        "  \"summary\": \"...\"\n"
-        "}\n\n"
-        "Text to summarize:\n"
-        + text
+async def process_text(user_id: str = Form(...), title: str = Form(...), text: str = Form(...),
+                       refresh: bool = Form(False)):
+    model = get_template_model("summary_text")
+    cache_key = gemini_cache_key(text, "models/gemini-2.5-flash", "summary_text", SUMMARY_TEXT_MAX_TOKENS, 0.3)
+    if refresh:
+        _gemini_cache.pop(cache_key, None)
+    return StreamingResponse(
+        stream_and_save(
+            model,
+            text,
+            generation_config=generation_config_for("summary_text", SUMMARY_TEXT_MAX_TOKENS, 0.3),
+            user_id=user_id,
+            title=title,
+            cache_key=cache_key
+        ),
+        media_type="application/x-ndjson"
     )
-    ai = call_gemini(prompt)
-    doc_id = save_to_firestore(user_id, title, ai)
-    return {"status": "ok", "doc_id": doc_id, "result": ai}
 
 @app.post("/upload-file")
 async def upload_file(user_id: str = Form(...), title: str = Form(...), file: UploadFile = File(...)):
+    gemini_file = None
     try:
-        # Read file bytes
-        file_bytes = await file.read()
-
         # Detect MIME type properly
         mime_type = file.content_type or "application/octet-stream"
 
-        # ---------- PROMPT ----------
-        prompt = """
-        You are an AI study assistant. Extract readable text from the uploaded file.
-        Then generate structured study material in strictly valid JSON:
-        {
-            "summary": "..."
-        }
-        Return ONLY JSON. No explanation text.
-        """
-
-        model = genai.GenerativeModel("models/gemini-2.5-flash")
-
-        response = model.generate_content(
-            [
-                {"mime_type": mime_type, "data": file_bytes},
-                prompt
-            ],
-            generation_config={
-                "temperature": 0.2,
-                "max_output_tokens": 2000
-            }
+        # Starlette has already spooled the upload to a temp file; hand that file
+        # to the Gemini Files API instead of reading it into memory
+        await file.seek(0)
+        gemini_file = await asyncio.to_thread(
+            genai.upload_file, file.file, mime_type=mime_type, display_name=file.filename or title
+        )
+        gemini_file = await wait_for_active_file(gemini_file)
+
+        # ---------- MODEL (instruction prompt as system instruction) ----------
+        model = get_template_model("summary_file")
+
+        return StreamingResponse(
+            stream_and_save(
+                model,
+                [gemini_file],
+                generation_config=generation_config_for("summary_file", SUMMARY_FILE_MAX_TOKENS, 0.2),
+                user_id=user_id,
+                title=title
+            ),
+            media_type="application/x-ndjson",
+            # uploaded files expire after 48h anyway; drop ours as soon as we're done
+            background=BackgroundTask(genai.delete_file, gemini_file.name)
         )
-
-        # ---------- GET RAW TEXT ----------
-        if not response.candidates:
-            return {"error": "No candidates returned from Gemini"}
-
-        full_text = ""
-        parts = response.candidates[0].content.parts
-        for p in parts:
-            if hasattr(p, "text"):
-                full_text += p.text
-
-        # ---------- EXTRACT JSON ----------
-        raw = extract_json(full_text)
-
-        # If backend output is { "raw_output": "{...json...}" }
-        if isinstance(raw, dict) and "raw_output" in raw:
-            try:
-                result = json.loads(raw["raw_output"])
-            except:
-                result = raw
-        else:
-            result = raw
-
-        # ---------- SAVE ----------
-        doc_id = save_to_firestore(user_id, title, result)
-
-        return {
-            "status": "ok",
-            "doc_id": doc_id,
-            "result": result
-        }
 
     except Exception as e:
-        return {
-            "error": str(e),
-            "traceback": traceback.format_exc()
-        }
+        payload = error_payload(e, "upload-file failed")
+        if gemini_file is not None:
+            try:
+                await asyncio.to_thread(genai.delete_file, gemini_file.name)
+            except Exception as delete_error:
+                logger.warning("Could not delete Gemini file %s: %s", gemini_file.name, delete_error)
+        return payload
 
 
 @app.post("/generate-mcq-flashcards")
@@ -299,79 +811,145 @@ async def generate_mcq_flashcards(
     user_id: str = Form(...),
     source_text: str = Form(None),
     doc_id: str = Form(None),
-    title: str = Form("MCQ & Flashcards")
+    title: str = Form("MCQ & Flashcards"),
+    refresh: bool = Form(False)
 ):
     """
     Generate MCQs and flashcards from provided text or existing saved doc_id (Firestore).
+    refresh=true bypasses the response cache and regenerates.
     """
     try:
         if not (source_text or doc_id):
-            return JSONResponse({"error": "Provide source_text or doc_id"}, status_code=400)
+            return ORJSONResponse({"error": "Provide source_text or doc_id"}, status_code=400)
 
         text = ""
         if doc_id:
             if firestore_client is None:
-                return JSONResponse({"error": "Firestore not initialized"}, status_code=500)
+                return ORJSONResponse({"error": "Firestore not initialized"}, status_code=500)
 
-            doc_ref = firestore_client.collection("users").document(user_id)\
-                                      .collection("notes").document(doc_id)
-            doc = doc_ref.get()
-
-            if not doc.exists:
-                return JSONResponse({"error": "doc_id not found"}, status_code=404)
-
-            stored = doc.to_dict().get("result", {})
-            text = stored.get("summary") or stored.get("raw_output") or json.dumps(stored)
+            text = await load_note_text(user_id, doc_id)
+            if text is None:
+                return ORJSONResponse({"error": "doc_id not found"}, status_code=404)
         else:
             text = source_text
 
-        # ---------- SAFE PROMPT ----------
-        prompt = (
-            "Your task is to return ONE single JSON object with EXACTLY the following keys:\n\n"
-            "{\n"
-            "  \"flashcards\": [\n"
-            "    {\"q\": \"\", \"a\": \"\"},\n"
-            "    {\"q\": \"\", \"a\": \"\"},\n"
-            "    {\"q\": \"\", \"a\": \"\"},\n"
-            "    {\"q\": \"\", \"a\": \"\"},\n"
-            "    {\"q\": \"\", \"a\": \"\"}\n"
-            "  ],\n"
-            "}\n\n"
-            "Rules:\n"
-            "- Return ONLY JSON.\n"
-            "- No markdown.\n"
-            "- No extra text.\n"
-            "- No explanations.\n"
-            "- All questions must be based STRICTLY on the provided text.\n\n"
-            "Text:\n" + text
-        )
-
-        ai_out = call_gemini(prompt, max_output_tokens=1200)
+        ai_out = await call_gemini(text, "flashcards", max_output_tokens=FLASHCARD_MAX_TOKENS, use_cache=not refresh)
+        if isinstance(ai_out, dict) and "error" in ai_out:
+            # nothing worth saving; tell the client instead of returning an empty "ok"
+            if ai_out["error"] == "gemini_busy":
+                return ORJSONResponse(ai_out, status_code=503, headers={"Retry-After": "30"})
+            return ORJSONResponse(ai_out, status_code=502)
 
         # ---- SAVE ----
         try:
-            saved_id = save_to_firestore(user_id, title, ai_out)
+            saved_id = await save_to_firestore(user_id, title, ai_out)
         except Exception as e:
             logger.warning("Could not save MCQ/flashcards to Firestore: %s", e)
             saved_id = None
         if isinstance(ai_out, dict) and "raw_output" in ai_out:
             try:
-                ai_out = json.loads(ai_out["raw_output"])
+                ai_out = orjson.loads(ai_out["raw_output"])
             except:
                 pass
         english_output = convert_to_english(ai_out)
 
-        return JSONResponse({
+        return ORJSONResponse({
             "status": "ok",
             "doc_id": saved_id,
-            "result": convert_to_english(ai_out)  # MUST BE formatted English
+            "result": english_output  # MUST BE formatted English
             })
 
 
     except Exception as e:
-        logger.exception("generate-mcq-flashcards failed")
-        return JSONResponse(
-            {"error": str(e), "traceback": traceback.format_exc()},
+        return ORJSONResponse(
+            error_payload(e, "generate-mcq-flashcards failed"),
+            status_code=500
+        )
+
+
+@app.post("/generate-mcq-flashcards-batch")
+async def generate_mcq_flashcards_batch(
+    user_id: str = Form(...),
+    doc_ids: str = Form(None),
+    source_text: str = Form(None),
+    title: str = Form("MCQ & Flashcards")
+):
+    """
+    Queue flashcard generation through Gemini Batch Mode (half price, results within 24h).
+    doc_ids is a comma-separated list of saved notes. Results are stored by /poll-batches.
+    """
+    try:
+        ids = [d.strip() for d in (doc_ids or "").split(",") if d.strip()]
+        if not (ids or source_text):
+            return ORJSONResponse({"error": "Provide source_text or doc_ids"}, status_code=400)
+        if firestore_client is None:
+            return ORJSONResponse({"error": "Firestore not initialized"}, status_code=500)
+        if batch_client is None:
+            return ORJSONResponse({"error": "Gemini batch client not initialized"}, status_code=500)
+
+        # fetch all notes concurrently: one round-trip of latency instead of one per note
+        texts = await asyncio.gather(*(load_note_text(user_id, did) for did in ids))
+        requests = []
+        for did, text in zip(ids, texts):
+            if text is None:
+                return ORJSONResponse({"error": f"doc_id not found: {did}"}, status_code=404)
+            requests.append({"key": did, "request": build_flashcard_batch_request(text)})
+        if source_text:
+            requests.append({"key": "source_text", "request": build_flashcard_batch_request(source_text)})
+
+        job_name = await asyncio.to_thread(submit_flashcard_batch, requests, f"flashcards-{user_id}")
+
+        job_ref = firestore_client.collection("batch_jobs").document()
+        await asyncio.to_thread(job_ref.set, {
+            "user_id": user_id,
+            "title": title,
+            "job_name": job_name,
+            "keys": [r["key"] for r in requests],
+            "state": "PENDING",
+            "created_at": SERVER_TIMESTAMP
+        })
+        return {"status": "queued", "batch_id": job_ref.id, "job_name": job_name}
+
+    except Exception as e:
+        return ORJSONResponse(
+            error_payload(e, "generate-mcq-flashcards-batch failed"),
+            status_code=500
+        )
+
+
+@app.post("/poll-batches")
+async def poll_batches():
+    """
+    Check pending Gemini batch jobs and save finished flashcards to Firestore.
+    Meant to be hit periodically by Cloud Scheduler.
+    """
+    try:
+        if firestore_client is None or batch_client is None:
+            return ORJSONResponse({"error": "Firestore or Gemini batch client not initialized"}, status_code=500)
+
+        query = firestore_client.collection("batch_jobs").where("state", "in", ["PENDING", "PROCESSING"])
+        pending = await asyncio.to_thread(lambda: list(query.stream()))
+
+        finished = []
+        failed = []
+        limit = asyncio.Semaphore(BATCH_POLL_CONCURRENCY)
+
+        async def collect(snap):
+            # one bad job must not block the rest
+            async with limit:
+                try:
+                    if await process_batch_job(snap):
+                        finished.append(snap.id)
+                except Exception as e:
+                    failed.append({"batch_id": snap.id, **error_payload(e, f"poll-batches: job {snap.id} failed")})
+
+        await asyncio.gather(*(collect(snap) for snap in pending))
+
+        return {"status": "ok", "checked": len(pending), "finished": finished, "failed": failed}
+
+    except Exception as e:
+        return ORJSONResponse(
+            error_payload(e, "poll-batches failed"),
             status_code=500
         )
 
@@ -381,8 +959,7 @@ def list_models():
     try:
         return genai.list_models()
     except Exception as e:
-        logger.exception("list-models failed")
-        return JSONResponse({"error": str(e), "traceback": traceback.format_exc()}, status_code=500)
+        return ORJSONResponse(error_payload(e, "list-models failed"), status_code=500)
 
 # Run local dev
 if __name__ == "__main__":